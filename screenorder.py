@@ -1,122 +1,241 @@
 #!/usr/bin/env python3
 """Order screens using xrandr."""
 import argparse
+import getpass
 import json
 import os
 import re
+import shlex
+import signal
+import socket
+import struct
 import subprocess
 import sys
 
-from itertools import accumulate
+from dataclasses import dataclass
 from pathlib import Path
 from pprint import pprint
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_CONFIG_FILE = os.path.join(
+    os.path.expanduser("~"), ".config/screenorder/screenorder_config.json"
+)
+_CONFIG_CACHE = {"path": None, "mtime": None, "data": None}
+_CONNECTOR_PREFIXES = ("DP-", "HDMI-", "eDP-", "DVI-", "VGA-")
+_I3_IPC_MAGIC = b"i3-ipc"
+_I3_IPC_RUN_COMMAND = 0
+_MODE_RE = re.compile(r"\s+(\d+x\d+)\S*\s+\d+\.\d+")
+_LAYOUT_RE = re.compile(
+    r"\S+ (?:dis)?connected (primary )?(\d+)x(\d+)\+(\d+)\+(\d+) "
+    r"(normal|left|right|inverted)?"
+)
+_SCREEN_RE = re.compile(r"Screen \d+: .*current (\d+) x (\d+),")
+_ROTATE_SWAP = frozenset(("left", "right"))
+
+
+@dataclass(slots=True)
+class Monitor:
+    """A monitor connected to an output and its configuration"""
+
+    edid: str
+    resolution: str | None = None
+    order: int | None = None
+    description: str | None = None
+    rotate: str | None = None
+    primary: bool = False
+    i3_workspaces: list | None = None
+
+    def configure(self, monitor_config):
+        """Apply the configuration of the monitor from the config file"""
+        self.order = monitor_config["order"]
+        self.description = monitor_config.get("description", None)
+        self.resolution = monitor_config.get("resolution", self.resolution)
+        self.rotate = monitor_config.get("rotate", None)
+        self.primary = monitor_config.get("primary", False)
+        self.i3_workspaces = monitor_config.get("i3-workspaces", None)
+
+
+def loads_json(data):
+    """Parse JSON from bytes, using orjson when it is available"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps_json(obj):
+    """Serialize to JSON bytes, using orjson when it is available"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf8")
+
 
 def get_config_file_name():
     """Get the config file path."""
-    return os.path.join(str(Path.home()), ".config/screenorder/screenorder_config.json")
+    return _CONFIG_FILE
 
 
 def read_monitor_config():
-    """Read configuration of monitors from file"""
+    """Read configuration of monitors from file
+
+    The parsed configuration is kept until the file is modified.
+    """
     config_path = Path(get_config_file_name())
     if not config_path.is_file():
         config_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(config_path, "w", encoding="utf8") as config_file:
-            config_file.write("{}")
-    with open(
-        config_path,
-        "r",
-        encoding="utf8",
-    ) as screen_order_file:
-        return json.load(screen_order_file)
+        with open(config_path, "wb") as config_file:
+            config_file.write(dumps_json({}))
+    mtime = config_path.stat().st_mtime_ns
+    if _CONFIG_CACHE["path"] == config_path and _CONFIG_CACHE["mtime"] == mtime:
+        return _CONFIG_CACHE["data"]
+    with open(config_path, "rb") as screen_order_file:
+        config = loads_json(screen_order_file.read())
+    _CONFIG_CACHE.update(path=config_path, mtime=mtime, data=config)
+    return config
+
+
+def run_process(args, parse=None):
+    """Run a process and optionally parse its output line by line
+
+    The process is started with os.posix_spawnp, which avoids the setup cost
+    of subprocess.Popen. Output is parsed while it is written, and stderr is
+    hidden while doing so.
+    """
+    file_actions = []
+    if parse is not None:
+        read_fd, write_fd = os.pipe()
+        file_actions.append((os.POSIX_SPAWN_DUP2, write_fd, 1))
+        file_actions.append((os.POSIX_SPAWN_OPEN, 2, os.devnull, os.O_WRONLY, 0))
+    try:
+        pid = os.posix_spawnp(
+            args[0],
+            args,
+            os.environ,
+            file_actions=file_actions,
+            # Python ignores these, restore the defaults like subprocess does
+            setsigdef=(signal.SIGPIPE, signal.SIGXFSZ),
+        )
+    except OSError:
+        if parse is not None:
+            os.close(read_fd)
+        raise
+    finally:
+        if parse is not None:
+            os.close(write_fd)
+    res = None
+    try:
+        if parse is not None:
+            # Closing the pipe before waiting lets the process exit through
+            # SIGPIPE even if parsing stopped before the end of its output
+            with open(read_fd, "r", encoding="utf8") as output:
+                res = parse(output)
+    finally:
+        _, status = os.waitpid(pid, 0)
+    returncode = os.waitstatus_to_exitcode(status)
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, args)
+    return res
 
 
 def get_monitors_info():
-    """Get information about monitors from xrandr"""
-    xrandr_output = subprocess.run(
-        [
-            "xrandr",
-            "--verbose",
-        ],
-        capture_output=True,
-        encoding="utf8",
-        check=True,
-    ).stdout
-    return parse_xrandr_output(xrandr_output)
-
-
-def parse_xrandr_output(xrandr_output):
+    """Get information about monitors from xrandr
+
+    `xrandr --prop` lists the EDID of each monitor like `xrandr --verbose`
+    does, but with one line per mode instead of a detailed block per mode.
+    """
+    return run_process(["xrandr", "--prop"], parse_xrandr_output)
+
+
+def parse_xrandr_output(xrandr_lines):
+    """Parse monitors from `xrandr --prop` output
+
+    Also returns the current layout of every output with a CRTC, connected or
+    not, in the form produced by get_layout, and the current framebuffer size.
+    """
     state = "scanning"
     identifier = None
     res = {}
     disabled = set()
-    tmp_res = []
-    for line in xrandr_output.splitlines():
+    current = {}
+    fb_size = None
+    tmp_res = bytearray()
+    match_mode = _MODE_RE.match
+    for line in xrandr_lines:
         if state == "scanning":
             if line.strip() == "EDID:":
                 state = "munching"
-            elif (
-                line.startswith("DP-")
-                or line.startswith("HDMI-")
-                or line.startswith("eDP-")
-                or line.startswith("DVI-")
-            ):
+            elif line.startswith("Screen ") and (match := _SCREEN_RE.match(line)):
+                # match e. g:
+                # Screen 0: minimum 8 x 8, current 5760 x 2160, maximum 32767 x 32767
+                fb_size = "x".join(match.groups())
+            elif line and line[0] in "DHeV" and line.startswith(_CONNECTOR_PREFIXES):
                 if identifier is not None and identifier not in res:
                     disabled.add(identifier)
                 identifier = line.split()[0]
-            elif match := re.match(r"\s*(\d+x\d+) \(0x[0-9a-f]+\).*\+preferred", line):
-                # Try to find a preferred resolution
+                if match := _LAYOUT_RE.match(line):
+                    # match e. g:
+                    # DP-0 connected primary 3840x2160+0+0 (normal left ...)
+                    # HDMI-0 connected 1200x1920+3840+0 left (normal left ...)
+                    # DP-1 disconnected 1920x1200+5040+0 (normal left ...)
+                    primary, width, height, x_pos, y_pos, rotate = match.groups()
+                    rotate = rotate or "normal"
+                    if rotate in _ROTATE_SWAP:
+                        width, height = height, width
+                    current[identifier] = (
+                        f"{width}x{height}",
+                        int(x_pos),
+                        int(y_pos),
+                        rotate,
+                        primary is not None,
+                    )
+            elif "+" in line and (match := match_mode(line)):
+                # Try to find a preferred resolution, marked with a +
                 # match e. g:
-                # 3840x2160 (0x21e) 533.250MHz +HSync -VSync +preferred
+                # 3840x2160     60.00*+  30.00
                 if identifier in res:
-                    res[identifier]["resolution"] = match.groups()[0]
-            elif match := re.match(r"\s*(\d+x\d+) \(0x[0-9a-f]+\)", line):
+                    res[identifier].resolution = match.groups()[0]
+            elif match := match_mode(line):
                 # Try to find any supported resolution (just pick the first one)
                 # match e. g:
-                # 5120x2160 (0x220) 730.730MHz +HSync +VSync
-                if identifier in res and "resolution" not in res[identifier]:
-                    res[identifier]["resolution"] = match.groups()[0]
+                # 5120x2160     60.00    30.00
+                if identifier in res and res[identifier].resolution is None:
+                    res[identifier].resolution = match.groups()[0]
         elif state == "munching":
             if ":" in line:
                 state = "scanning"
-                res[identifier] = {"edid": "".join(tmp_res)}
-                tmp_res = []
+                res[identifier] = Monitor(edid=tmp_res.decode("ascii"))
+                tmp_res.clear()
             else:
-                tmp_res.append(line.strip())
-    return res, disabled
-
-
-def get_x_resolution(monitor):
-    """Get the x resolution from a string like 1920x1200"""
-    resolution_string = monitor["resolution"]
-    parts = resolution_string.split("x")
-    if "rotate" in monitor and monitor["rotate"] in ["left", "right"]:
-        return int(parts[1])
-    return int(parts[0])
+                # EDID lines are hex, so they are plain ASCII
+                tmp_res += line.strip().encode("ascii")
+    if identifier is not None and identifier not in res:
+        disabled.add(identifier)
+    return res, disabled, current, fb_size
 
 
-def get_y_resolution(monitor):
-    """Get the x resolution from a string like 1920x1200"""
-    resolution_string = monitor["resolution"]
-    parts = resolution_string.split("x")
-    if "rotate" in monitor and monitor["rotate"] in ["left", "right"]:
-        return int(parts[0])
-    return int(parts[1])
+def get_resolution(monitor):
+    """Get the x and y resolution from a string like 1920x1200"""
+    x_resolution, _, y_resolution = monitor.resolution.partition("x")
+    if monitor.rotate in _ROTATE_SWAP:
+        return int(y_resolution), int(x_resolution)
+    return int(x_resolution), int(y_resolution)
 
 
 def configure_monitors(monitors, config):
     """Return monitors configured by config"""
     selected_monitors = {}
     for identifier, monitor in monitors.items():
-        monitor_config = config.get(monitor["edid"], None)
+        monitor_config = config.get(monitor.edid, None)
         if monitor_config is None:
             print(f"Did not find monitor {identifier} in {get_config_file_name()}")
             print("Insert:")
             print(
                 json.dumps(
                     {
-                        monitor["edid"]: {
+                        monitor.edid: {
                             "order": "<Order goes here. E. g. 1, 2, 3>",
                             "description": "<Short description of monitor>",
                             "resolution": "Optional: Override default resolution. Format WxH",
@@ -128,28 +247,60 @@ def configure_monitors(monitors, config):
                 )
             )
         else:
-            monitor.update(monitor_config)
+            monitor.configure(monitor_config)
             selected_monitors[identifier] = monitor
 
     if len(selected_monitors) != len(
-        set(monitor["order"] for monitor in selected_monitors.values())
+        set(monitor.order for monitor in selected_monitors.values())
     ):
         print("Monitor order collision in set:")
         pprint(selected_monitors)
         return None
-    ordered_monitors = dict(
-        sorted(selected_monitors.items(), key=lambda item: item[1]["order"])
-    )
+    ordered_monitors = sorted(selected_monitors.items(), key=lambda item: item[1].order)
 
-    primary_monitor_index = (max(len(ordered_monitors) - 1, 0)) // 2
-    for i, key in enumerate(ordered_monitors.keys()):
-        if i == primary_monitor_index:
-            ordered_monitors[key]["primary"] = True
+    if ordered_monitors:
+        primary_monitor_index = (len(ordered_monitors) - 1) // 2
+        ordered_monitors[primary_monitor_index][1].primary = True
 
     return ordered_monitors
 
 
-def generate_xrandr_command(ordered_monitors, disabled, force_panning):
+def get_layout(ordered_monitors):
+    """Get the layout to set up for the monitors
+
+    Returns the framebuffer size and, per output, a tuple of mode, x and y
+    position, rotation and whether the monitor is primary.
+    """
+    fb_width = 0
+    fb_height = 0
+    layout = {}
+    for identifier, monitor in ordered_monitors:
+        x_resolution, y_resolution = get_resolution(monitor)
+        layout[identifier] = (
+            monitor.resolution,
+            fb_width,
+            0,
+            monitor.rotate or "normal",
+            monitor.primary,
+        )
+        fb_width += x_resolution
+        fb_height = max(fb_height, y_resolution)
+    return f"{fb_width}x{fb_height}", layout
+
+
+def is_layout_current(fb_size, layout, disabled, current_fb_size, current):
+    """Check if the monitors are already laid out as configured"""
+    return (
+        fb_size == current_fb_size
+        and all(
+            current.get(identifier) == monitor_layout
+            for identifier, monitor_layout in layout.items()
+        )
+        and not any(identifier in current for identifier in disabled)
+    )
+
+
+def generate_xrandr_command(fb_size, layout, disabled, force_panning):
     """Generate command
 
     Example resulting command
@@ -158,95 +309,112 @@ def generate_xrandr_command(ordered_monitors, disabled, force_panning):
         --output DP-0.2.1.8 --mode 1920x1200 --panning 1920x1200+1920+0 --pos 1920x0 \
         --output DP-0.2.1.1 --mode 1920x1200 --panning 1920x1200+3840+0 --pos 3840x0
     """
-    offsets = [0]
-    offsets.extend(
-        accumulate(get_x_resolution(monitor) for monitor in ordered_monitors.values())
-    )
-
-    monitor_info = [
-        (
-            identifier,
-            monitor["resolution"],
-            offset,
-            monitor.get("rotate", None),
-            monitor.get("primary", None),
-        )
-        for (identifier, monitor), offset in zip(ordered_monitors.items(), offsets)
-    ]
-    fb_width = sum(get_x_resolution(monitor) for monitor in ordered_monitors.values())
-    fb_height = max(get_y_resolution(monitor) for monitor in ordered_monitors.values())
-    res = ["xrandr", "--fb", f"{fb_width}x{fb_height}"]
-    for identifier, resolution, monitor_x_pos, rotate, primary in monitor_info:
-        res.extend(
-            [
-                "--output",
-                identifier,
-                "--mode",
-                resolution,
-                "--pos",
-                f"{monitor_x_pos}x0",
-            ]
-        )
+    res = ["xrandr", "--fb", fb_size]
+    append = res.append
+    for identifier, monitor_layout in layout.items():
+        resolution, monitor_x_pos, monitor_y_pos, rotate, primary = monitor_layout
+        append("--output")
+        append(identifier)
+        append("--mode")
+        append(resolution)
+        append("--pos")
+        append(f"{monitor_x_pos}x{monitor_y_pos}")
         if force_panning:
-            res.extend(
-                [
-                    "--panning",
-                    f"{resolution}+{monitor_x_pos}+0",
-                ]
-            )
-        if rotate:
-            res.extend(
-                [
-                    "--rotate",
-                    rotate,
-                ]
-            )
+            append("--panning")
+            append(f"{resolution}+{monitor_x_pos}+{monitor_y_pos}")
+        append("--rotate")
+        append(rotate)
         if primary:
-            res.extend(
-                [
-                    "--primary",
-                ]
-            )
+            append("--primary")
     for identifier in disabled:
-        res.extend(
-            [
-                "--output",
-                identifier,
-                "--off",
-            ]
-        )
+        append("--output")
+        append(identifier)
+        append("--off")
     return res
 
 
-def is_i3_running():
-    """Check if i3 is running"""
-    return subprocess.run(["pgrep", "-x", "i3"], check=False, capture_output=True)
+def is_socket_listening(socket_path):
+    """Check if a unix socket accepts connections"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe_socket:
+        try:
+            probe_socket.connect(socket_path)
+        except OSError:
+            return False
+    return True
 
 
-def generate_i3_commands(ordered_monitors):
-    """Generate commands to order workspaces in i3"""
-    if not is_i3_running():
+def get_i3_socket_path():
+    """Get the path of the i3 IPC socket, or None if i3 is not listening
+
+    Sockets left behind by crashed or old i3 sessions are skipped.
+    """
+    candidates = []
+    if socket_path := os.environ.get("I3SOCK"):
+        candidates.append(socket_path)
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir is not None:
+        socket_paths = list(Path(runtime_dir, "i3").glob("ipc-socket.*"))
+    else:
+        socket_paths = list(Path(f"/run/user/{os.getuid()}/i3").glob("ipc-socket.*"))
+        # Without XDG_RUNTIME_DIR i3 creates its socket in a /tmp directory
+        socket_paths.extend(Path("/tmp").glob(f"i3-{getpass.getuser()}.*/ipc-socket.*"))
+    candidates.extend(
+        str(socket_path)
+        for socket_path in sorted(
+            socket_paths,
+            key=lambda socket_path: socket_path.stat().st_mtime,
+            reverse=True,
+        )
+    )
+    for socket_path in candidates:
+        if is_socket_listening(socket_path):
+            return socket_path
+    return None
+
+
+def generate_i3_commands(ordered_monitors, i3_socket_path, check_i3=True):
+    """Generate commands to order workspaces in i3
+
+    With check_i3 unset the commands are generated even if i3 is not running,
+    which lets a dry run show them without probing for i3.
+    """
+    if not ordered_monitors or (check_i3 and i3_socket_path is None):
         return []
     res = []
-    for output, monitor in ordered_monitors.items():
-        if "i3-workspaces" in monitor:
-            for workspace in monitor["i3-workspaces"]:
+    for output, monitor in ordered_monitors:
+        if monitor.i3_workspaces is not None:
+            for workspace in monitor.i3_workspaces:
                 res.append(
-                    [
-                        "i3-msg",
-                        f"workspace number {workspace}; move workspace to output {output}",
-                    ]
+                    f"workspace number {workspace}; move workspace to output {output}"
                 )
         else:
             res.append(
-                [
-                    "i3-msg",
-                    f"workspace number {monitor['order']}; move workspace to output {output}",
-                ]
+                f"workspace number {monitor.order}; move workspace to output {output}"
             )
     return res
 
 
+def run_i3_command(socket_path, command):
+    """Run a command through the i3 IPC socket and return the results"""
+    payload = command.encode("utf8")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as i3_socket:
+        i3_socket.connect(socket_path)
+        i3_socket.sendall(
+            _I3_IPC_MAGIC
+            + struct.pack("=II", len(payload), _I3_IPC_RUN_COMMAND)
+            + payload
+        )
+        with i3_socket.makefile("rb") as reply_file:
+            header_size = len(_I3_IPC_MAGIC) + 8
+            header = reply_file.read(header_size)
+            if len(header) != header_size or not header.startswith(_I3_IPC_MAGIC):
+                raise ConnectionError("Invalid reply header from i3")
+            length, reply_type = struct.unpack("=II", header[len(_I3_IPC_MAGIC) :])
+            if reply_type != _I3_IPC_RUN_COMMAND:
+                raise ConnectionError(f"Unexpected reply type {reply_type} from i3")
+            return loads_json(reply_file.read(length))
+
+
 def main():
     """Reorder monitors using xrandr"""
     parser = argparse.ArgumentParser("screenorder")
@@ -258,25 +426,43 @@ def main():
         with open(
             args.debug_parse_xrandr_output_file, "r", encoding="utf-8"
         ) as xrandr_output_file:
-            contents = xrandr_output_file.read()
-        pprint(parse_xrandr_output(contents))
+            pprint(parse_xrandr_output(xrandr_output_file))
         return 0
-    monitors, disabled = get_monitors_info()
+    monitors, disabled, current, current_fb_size = get_monitors_info()
     config = read_monitor_config()
     ordered_monitors = configure_monitors(monitors, config)
     if not ordered_monitors:
         sys.exit(1)
-    cmd = generate_xrandr_command(ordered_monitors, disabled, args.force_panning)
-    if not cmd:
-        sys.exit(1)
-    print(f"Running \"{' '.join(cmd)}\"")
-    if not args.dry_run:
-        subprocess.run(cmd, check=True)
-    cmds = generate_i3_commands(ordered_monitors)
-    for cmd in cmds:
-        print(f"Running \"{' '.join(cmd)}\"")
+    fb_size, layout = get_layout(ordered_monitors)
+    # Panning is not listed by xrandr --prop, so it can not be compared
+    if not args.force_panning and is_layout_current(
+        fb_size, layout, disabled, current_fb_size, current
+    ):
+        print("Monitors are already in order, not running xrandr")
+    else:
+        cmd = generate_xrandr_command(fb_size, layout, disabled, args.force_panning)
+        if not cmd:
+            sys.exit(1)
+        print(f'Running "{shlex.join(cmd)}"')
+        if not args.dry_run:
+            run_process(cmd)
+    i3_socket_path = None if args.dry_run else get_i3_socket_path()
+    i3_commands = generate_i3_commands(
+        ordered_monitors, i3_socket_path, check_i3=not args.dry_run
+    )
+    if i3_commands:
+        i3_command = "; ".join(i3_commands)
+        print(f'Running i3 command "{i3_command}"')
         if not args.dry_run:
-            subprocess.run(cmd, check=True, capture_output=True)
+            try:
+                results = run_i3_command(i3_socket_path, i3_command)
+            except OSError as error:
+                print(f"Could not send i3 command: {error}")
+                sys.exit(1)
+            for result in results:
+                if not result["success"]:
+                    print(f"i3 command failed: {result.get('error')}")
+                    sys.exit(1)
     sys.exit(0)
 
 